@@ -7,24 +7,70 @@
 # decrypted in memory.
 #
 # Crypto choices:
-# - Key derivation: scrypt (memory-hard, resists GPU attacks)
-# - Encryption: Fernet (AES-128-CBC + HMAC-SHA256)
-# - Encoding: base64 (standard, Fernet-native)
+# - Key derivation: Argon2id (memory-hard, resists GPU and side-channel
+#   attacks); scrypt for v1/v2 blobs
+# - Encryption: AES-128-CBC + HMAC-SHA256 (Fernet's construction, minus
+#   the Fernet wrapper's base64/timestamp overhead; v1 blobs are Fernet)
+# - Encoding: base64 (pybase64's SIMD codec when installed)
 
-import base64
+import hashlib
 import json
 import os
+import struct
+import threading
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
+from hmac import compare_digest
 
 from cryptography.fernet import Fernet, InvalidToken
-from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
-
-
-# scrypt parameters (OWASP recommended for interactive login)
+from cryptography.hazmat.primitives import hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.hashes import SHA256
+
+# pybase64 is an optional, API-compatible SIMD replacement for base64
+try:
+    from pybase64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
+except ImportError:
+    from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
+
+# orjson is an optional speedup; its JSONDecodeError subclasses the stdlib one
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Argon2id parameters (RFC 9106 / OWASP: t=3, 64 MiB)
+ARGON2_TIME_COST = 3  # iterations
+ARGON2_MEMORY_COST = 64 * 1024  # KiB
+ARGON2_PARALLELISM = 1
+ARGON2_LENGTH = 32  # output key length: 16 bytes AES + 16 bytes HMAC
+
+# scrypt parameters for v1/v2 blobs (OWASP recommended for interactive login)
 SCRYPT_N = 2**14  # CPU/memory cost
 SCRYPT_R = 8  # block size
 SCRYPT_P = 1  # parallelization
-SCRYPT_LENGTH = 32  # output key length for Fernet
+SCRYPT_LENGTH = 32  # output key length: 16 bytes AES + 16 bytes HMAC
+
+# Blob versions
+BLOB_VERSION_FERNET = 1  # legacy: scrypt, ciphertext is a Fernet token
+BLOB_VERSION_AES_HMAC = 2  # scrypt, ciphertext is version || iv || ct || tag
+BLOB_VERSION_ARGON2 = 3  # Argon2id, same ciphertext layout as v2
+SUPPORTED_BLOB_VERSIONS = (BLOB_VERSION_FERNET, BLOB_VERSION_AES_HMAC, BLOB_VERSION_ARGON2)
+CURRENT_BLOB_VERSION = BLOB_VERSION_ARGON2
+
+IV_LENGTH = 16
+TAG_LENGTH = 32
+
+# Derived-key cache: skips repeated KDF work for the same salt + password
+KEY_CACHE_SIZE = 8
+KEY_CACHE_TTL_SECONDS = 30 * 60  # matches the app's session timeout
+
+# (salt, password fingerprint) -> (expires_at, key)
+_key_cache: OrderedDict[tuple[bytes, bytes], tuple[float, bytearray]] = OrderedDict()
+# Streamlit runs each session's script in its own thread
+_key_cache_lock = threading.Lock()
 
 
 @dataclass
@@ -36,30 +82,87 @@ class EncryptedBlob:
     ciphertext: bytes
 
     def to_string(self) -> str:
-        """Encode blob as a single base64 string for storage."""
-        payload = {
-            "v": self.version,
-            "s": base64.b64encode(self.salt).decode("ascii"),
-            "c": base64.b64encode(self.ciphertext).decode("ascii"),
-        }
-        return base64.b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+        """Encode blob as a single base64 string for storage.
+
+        Layout: version (1B) || salt length (1B) || salt || ciphertext.
+        """
+        header = struct.pack(">BB", self.version, len(self.salt))
+        return urlsafe_b64encode(header + self.salt + self.ciphertext).decode("ascii")
 
     @classmethod
     def from_string(cls, encoded: str) -> "EncryptedBlob":
-        """Decode blob from a base64 string."""
+        """Decode blob from a base64 string (binary or legacy JSON layout)."""
         try:
-            payload = json.loads(base64.b64decode(encoded))
-            return cls(
-                version=payload["v"],
-                salt=base64.b64decode(payload["s"]),
-                ciphertext=base64.b64decode(payload["c"]),
-            )
+            # Legacy blobs use the standard alphabet ("+" and "/")
+            if "+" in encoded or "/" in encoded:
+                raw = b64decode(encoded)
+            else:
+                raw = urlsafe_b64decode(encoded)
+            if raw[:1] == b"{":
+                return cls._from_legacy_json(raw)
+
+            if len(raw) < 2:
+                raise ValueError("blob too short")
+            version, salt_len = struct.unpack_from(">BB", raw)
+            salt = raw[2 : 2 + salt_len]
+            if len(salt) != salt_len:
+                raise ValueError("truncated salt")
+            return cls(version=version, salt=salt, ciphertext=raw[2 + salt_len :])
         except (json.JSONDecodeError, KeyError, ValueError) as e:
             raise ValueError(f"Invalid encrypted blob format: {e}") from e
 
+    @classmethod
+    def _from_legacy_json(cls, raw: bytes) -> "EncryptedBlob":
+        """Decode the original base64(JSON) layout, kept so old blobs still load."""
+        payload = _json_loads(raw)
+        return cls(
+            version=payload["v"],
+            salt=b64decode(payload["s"]),
+            ciphertext=b64decode(payload["c"]),
+        )
+
+
+def _json_dumps(obj) -> bytes:
+    """Serialize to UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def _json_loads(data: bytes | str):
+    """Parse JSON from bytes or str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _derive_key(password: str, salt: bytes, version: int) -> bytes:
+    """Derive a raw 32-byte key from password with the blob version's KDF."""
+    if version >= BLOB_VERSION_ARGON2:
+        return _derive_key_argon2(password, salt)
+    return _derive_key_scrypt(password, salt)
+
+
+def _derive_key_argon2(password: str, salt: bytes) -> bytes:
+    """Derive a raw 32-byte key from password using Argon2id."""
+    # Deferred so importing this module stays cheap when no blob is configured
+    from argon2.low_level import Type, hash_secret_raw
+
+    return hash_secret_raw(
+        password.encode("utf-8"),
+        salt,
+        time_cost=ARGON2_TIME_COST,
+        memory_cost=ARGON2_MEMORY_COST,
+        parallelism=ARGON2_PARALLELISM,
+        hash_len=ARGON2_LENGTH,
+        type=Type.ID,
+    )
+
+
+def _derive_key_scrypt(password: str, salt: bytes) -> bytes:
+    """Derive a raw 32-byte key from password using scrypt."""
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
-def _derive_key(password: str, salt: bytes) -> bytes:
-    """Derive a Fernet-compatible key from password using scrypt."""
     kdf = Scrypt(
         salt=salt,
         length=SCRYPT_LENGTH,
@@ -67,7 +170,96 @@ def _derive_key(password: str, salt: bytes) -> bytes:
         r=SCRYPT_R,
         p=SCRYPT_P,
     )
-    return base64.urlsafe_b64encode(kdf.derive(password.encode("utf-8")))
+    return kdf.derive(password.encode("utf-8"))
+
+
+def _password_fingerprint(password: str, salt: bytes) -> bytes:
+    """Keyed BLAKE2b of the password, so raw passwords never become cache keys."""
+    return hashlib.blake2b(password.encode("utf-8"), digest_size=32, key=salt).digest()
+
+
+def zeroize(key: bytearray) -> None:
+    """Overwrite key material in place."""
+    key[:] = bytes(len(key))
+
+
+def _get_cached_key(salt: bytes, fingerprint: bytes) -> bytearray | None:
+    """Return a cached key for (salt, fingerprint), or None if missing or expired."""
+    with _key_cache_lock:
+        entry = _key_cache.get((salt, fingerprint))
+        if entry is None:
+            return None
+
+        expires_at, key = entry
+        if time.time() > expires_at:
+            zeroize(_key_cache.pop((salt, fingerprint))[1])
+            return None
+
+        _key_cache.move_to_end((salt, fingerprint))
+        return bytearray(key)
+
+
+def _cache_key(salt: bytes, fingerprint: bytes, key: bytes) -> None:
+    """Remember a derived key, evicting (and zeroizing) the least recently used."""
+    with _key_cache_lock:
+        old = _key_cache.pop((salt, fingerprint), None)
+        if old is not None:
+            zeroize(old[1])
+
+        _key_cache[(salt, fingerprint)] = (time.time() + KEY_CACHE_TTL_SECONDS, bytearray(key))
+        while len(_key_cache) > KEY_CACHE_SIZE:
+            zeroize(_key_cache.popitem(last=False)[1][1])
+
+
+def clear_key_cache() -> None:
+    """
+    Zeroize and drop every cached key.
+
+    The cache is shared by the whole process (every Streamlit session), so
+    this is for process-wide resets; one session's logout shouldn't call it.
+    """
+    with _key_cache_lock:
+        while _key_cache:
+            zeroize(_key_cache.popitem()[1][1])
+
+
+def _compute_tag(mac_key: bytes, data: bytes) -> bytes:
+    """HMAC-SHA256 over the authenticated part of a v2 ciphertext."""
+    h = hmac.HMAC(mac_key, SHA256())
+    h.update(data)
+    return h.finalize()
+
+
+def _encrypt_aes_hmac(key: bytes, plaintext: bytes) -> bytes:
+    """Encrypt with AES-128-CBC and append an HMAC-SHA256 tag."""
+    enc_key, mac_key = key[:16], key[16:32]
+    iv = os.urandom(IV_LENGTH)
+
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    padded = padder.update(plaintext) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(enc_key), modes.CBC(iv)).encryptor()
+    ct = encryptor.update(padded) + encryptor.finalize()
+
+    # The leading byte is the ciphertext layout, which v3 shares with v2
+    data = bytes([BLOB_VERSION_AES_HMAC]) + iv + ct
+    return data + _compute_tag(mac_key, data)
+
+
+def _decrypt_aes_hmac(key: bytes, ciphertext: bytes) -> bytes:
+    """Verify the HMAC tag, then decrypt. Raises DecryptionError on mismatch."""
+    enc_key, mac_key = key[:16], key[16:32]
+    if len(ciphertext) < 1 + IV_LENGTH + TAG_LENGTH:
+        raise DecryptionError("Ciphertext too short.")
+
+    data, tag = ciphertext[:-TAG_LENGTH], ciphertext[-TAG_LENGTH:]
+    if not compare_digest(_compute_tag(mac_key, data), tag):
+        raise DecryptionError("Wrong password or corrupted data.")
+
+    iv, ct = data[1 : 1 + IV_LENGTH], data[1 + IV_LENGTH :]
+    decryptor = Cipher(algorithms.AES(enc_key), modes.CBC(iv)).decryptor()
+    padded = decryptor.update(ct) + decryptor.finalize()
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+    return unpadder.update(padded) + unpadder.finalize()
 
 
 def encrypt_secrets(secrets: dict, password: str) -> str:
@@ -82,16 +274,100 @@ def encrypt_secrets(secrets: dict, password: str) -> str:
         Base64-encoded encrypted blob string
     """
     salt = os.urandom(16)
-    key = _derive_key(password, salt)
-    fernet = Fernet(key)
+    key = _derive_key(password, salt, CURRENT_BLOB_VERSION)
 
-    plaintext = json.dumps(secrets).encode("utf-8")
-    ciphertext = fernet.encrypt(plaintext)
+    plaintext = _json_dumps(secrets)
+    ciphertext = _encrypt_aes_hmac(key, plaintext)
 
-    blob = EncryptedBlob(version=1, salt=salt, ciphertext=ciphertext)
+    blob = EncryptedBlob(version=CURRENT_BLOB_VERSION, salt=salt, ciphertext=ciphertext)
     return blob.to_string()
 
 
+def _load_blob(blob_string: str) -> EncryptedBlob:
+    """Decode a blob string and check its version is supported."""
+    blob = EncryptedBlob.from_string(blob_string)
+
+    if blob.version not in SUPPORTED_BLOB_VERSIONS:
+        raise ValueError(f"Unsupported blob version: {blob.version}")
+    return blob
+
+
+def _verify_key(blob: EncryptedBlob, key: bytes) -> bool:
+    """Constant-time check of the blob's HMAC tag against a key."""
+    if blob.version == BLOB_VERSION_FERNET:
+        # Fernet token: base64(0x80 || timestamp || iv || ct || hmac), signing key first
+        mac_key = key[:16]
+        try:
+            token = urlsafe_b64decode(blob.ciphertext)
+        except ValueError:
+            token = b""
+    else:
+        mac_key = key[16:32]
+        token = blob.ciphertext
+
+    data, tag = token[:-TAG_LENGTH], token[-TAG_LENGTH:]
+    return compare_digest(_compute_tag(mac_key, data), tag)
+
+
+def _derive_verified_key(
+    blob_string: str, password: str
+) -> tuple[bytearray | None, EncryptedBlob]:
+    """
+    Check a password against a blob without decrypting it.
+
+    Always runs the full key derivation (never the key cache) and the
+    HMAC check, and reports a wrong password as None rather than by
+    raising, so every attempt costs the same.
+
+    Returns the key if it matches the blob, or None for a wrong password.
+    Callers own the returned bytearray and should zeroize() it when done.
+
+    Raises:
+        ValueError: If blob format is invalid
+    """
+    blob = _load_blob(blob_string)
+    key = bytearray(_derive_key(password, blob.salt, blob.version))
+    if not _verify_key(blob, key):
+        zeroize(key)
+        return None, blob
+    return key, blob
+
+
+def derive_key_from_blob(blob_string: str, password: str) -> tuple[bytearray, EncryptedBlob]:
+    """
+    Run the (expensive) key derivation for a blob.
+
+    The key is not verified here; a wrong password only shows up when
+    the key is used. Callers own the returned bytearray and should
+    zeroize() it when done.
+
+    Raises:
+        ValueError: If blob format is invalid
+    """
+    blob = _load_blob(blob_string)
+    key = _get_cached_key(blob.salt, _password_fingerprint(password, blob.salt))
+    if key is None:
+        key = bytearray(_derive_key(password, blob.salt, blob.version))
+    return key, blob
+
+
+def decrypt_with_key(blob: EncryptedBlob, key: bytes) -> dict:
+    """
+    Decrypt a blob with an already-derived key (no KDF work).
+
+    Raises:
+        DecryptionError: If key is wrong or data is corrupted
+        InvalidToken: Same, for legacy (v1, Fernet) blobs
+    """
+    if blob.version == BLOB_VERSION_FERNET:
+        fernet = Fernet(urlsafe_b64encode(key))
+        plaintext = fernet.decrypt(blob.ciphertext)
+    else:
+        plaintext = _decrypt_aes_hmac(key, blob.ciphertext)
+
+    return _json_loads(plaintext)
+
+
 def decrypt_secrets(blob_string: str, password: str) -> dict:
     """
     Decrypt a secrets blob with a password.
@@ -105,18 +381,16 @@ def decrypt_secrets(blob_string: str, password: str) -> dict:
 
     Raises:
         ValueError: If blob format is invalid
-        InvalidToken: If password is wrong or data is corrupted
+        DecryptionError: If password is wrong or data is corrupted
+        InvalidToken: Same, for legacy (v1, Fernet) blobs
     """
-    blob = EncryptedBlob.from_string(blob_string)
-
-    if blob.version != 1:
-        raise ValueError(f"Unsupported blob version: {blob.version}")
-
-    key = _derive_key(password, blob.salt)
-    fernet = Fernet(key)
-
-    plaintext = fernet.decrypt(blob.ciphertext)
-    return json.loads(plaintext.decode("utf-8"))
+    key, blob = derive_key_from_blob(blob_string, password)
+    try:
+        secrets = decrypt_with_key(blob, key)
+        _cache_key(blob.salt, _password_fingerprint(password, blob.salt), key)
+    finally:
+        zeroize(key)
+    return secrets
 
 
 class DecryptionError(Exception):
@@ -125,6 +399,26 @@ class DecryptionError(Exception):
     pass
 
 
+def _error_message(e: Exception) -> str:
+    """Map a decryption exception to a user-friendly message."""
+    if isinstance(e, ValueError):
+        return f"Invalid secrets format: {e}"
+    if isinstance(e, (DecryptionError, InvalidToken)):
+        return "Wrong password or corrupted data."
+    return f"Decryption failed: {e}"
+
+
+def _check_unlock_inputs(blob_string: str, password: str) -> str | None:
+    """Return an error message if there is nothing to decrypt."""
+    if not blob_string:
+        return "No encrypted secrets found. Use Config page to set up secrets."
+
+    if not password:
+        return "Password is required."
+
+    return None
+
+
 def try_decrypt_secrets(blob_string: str, password: str) -> tuple[dict | None, str | None]:
     """
     Try to decrypt secrets, returning (secrets, None) on success
@@ -133,18 +427,38 @@ def try_decrypt_secrets(blob_string: str, password: str) -> tuple[dict | None, s
     This is a convenience wrapper that catches exceptions and returns
     user-friendly error messages.
     """
-    if not blob_string:
-        return None, "No encrypted secrets found. Use Config page to set up secrets."
+    error = _check_unlock_inputs(blob_string, password)
+    if error:
+        return None, error
 
-    if not password:
-        return None, "Password is required."
+    try:
+        return decrypt_secrets(blob_string, password), None
+    except Exception as e:
+        return None, _error_message(e)
+
+
+def try_unlock_secrets(blob_string: str, password: str) -> tuple[bytearray | None, str | None]:
+    """
+    Like try_decrypt_secrets(), but returns the verified key instead of
+    the secrets, so callers can keep the key and decrypt on demand.
+    """
+    error = _check_unlock_inputs(blob_string, password)
+    if error:
+        return None, error
+
+    try:
+        # Lockout decisions happen only after this fixed-cost check
+        key, blob = _derive_verified_key(blob_string, password)
+    except Exception as e:
+        return None, _error_message(e)
+    if key is None:
+        return None, _error_message(DecryptionError())
 
     try:
-        secrets = decrypt_secrets(blob_string, password)
-        return secrets, None
-    except ValueError as e:
-        return None, f"Invalid secrets format: {e}"
-    except InvalidToken:
-        return None, "Wrong password or corrupted data."
+        decrypt_with_key(blob, key)
     except Exception as e:
-        return None, f"Decryption failed: {e}"
+        zeroize(key)
+        return None, _error_message(e)
+
+    # The caller keeps the key, so it isn't also put in the shared key cache
+    return key, None
@@ -7,21 +7,45 @@
 # - Password-protected secrets (encrypted at rest, decrypted transiently)
 # - Content is driven entirely by workflow_steps.md
 
+from __future__ import annotations
+
 from pathlib import Path
 from dataclasses import dataclass
+import hashlib
+import importlib.util
+import io
 import json
-import re
 import time
-import pandas as pd
+from typing import TYPE_CHECKING
+
 import streamlit as st
+from markdown_it import MarkdownIt
+
+# secrets_manager (and with it cryptography) is imported inside the functions
+# that use it, so apps without an encrypted blob never load it
 
-from secrets_manager import encrypt_secrets, try_decrypt_secrets
+if TYPE_CHECKING:
+    import pandas as pd
+
+# orjson is an optional speedup; its JSONDecodeError subclasses the stdlib one
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 WORKFLOW_MD = Path(__file__).parent / "workflow_steps.md"
 
+# File signatures used to tell Excel uploads from CSV
+XLSX_MAGIC = b"PK\x03\x04"
+XLS_MAGIC = b"\xd0\xcf\x11\xe0"
+
+# Use the (much faster) calamine Excel reader when it's installed (pandas 2.2+)
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else None
+
 # Security settings
 SESSION_TIMEOUT_SECONDS = 30 * 60  # 30 minutes of inactivity
 LOCKOUT_DELAYS = [0, 0, 5, 15, 30, 60]  # Escalating delays after failed attempts
+MIN_PASSWORD_LENGTH = 8  # Enforced at encrypt time, so shorter can't be right
 
 # Icons for each step (Material icons)
 STEP_ICONS = {
@@ -34,19 +58,74 @@ STEP_ICONS = {
     7: ":material/analytics:",
 }
 
+# Step bodies are rendered to HTML at parse time (which is cached). Tables and
+# strikethrough match st.markdown's GFM; Streamlit-only directives (icons,
+# colored text, emoji shortcodes, LaTeX) aren't supported in step bodies.
+# Raw HTML is escaped, as st.markdown does, since the output is rendered unsafe
+_MARKDOWN = MarkdownIt("commonmark", {"html": False}).enable(["table", "strikethrough"])
+
+# Step header lines look like "## Step N: Title"
+_STEP_PREFIX = "## Step "
+
+# Expander icon by step state; the active step keeps its own icon
+_ICON_FOR_STATE = {
+    "done": ":material/check_circle:",
+    "future": ":material/lock:",
+}
+
+# Shown in place of the body for steps that are still locked
+_FUTURE_CAPTION = "This step will unlock once you complete the previous step."
+
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Step:
     number: int
     title: str
     body: str
     icon: str = ""
+    body_html: str = ""  # body pre-rendered to HTML
 
 
-def load_markdown() -> str:
-    if not WORKFLOW_MD.exists():
+def load_markdown(path: Path = WORKFLOW_MD) -> str:
+    if not path.exists():
         return "# Missing workflow_steps.md\n\nPlease create the file."
-    return WORKFLOW_MD.read_text(encoding="utf-8")
+    return path.read_text(encoding="utf-8")
+
+
+def _find_step_headers(md: str) -> list[tuple[int, int, int, str | None]]:
+    """
+    Find "## Step N:" lines with plain string scanning.
+
+    Returns (line_start, line_end, number, title) for each such line. Lines
+    that end a step body but aren't a valid "## Step N: Title" header (empty
+    title, no space after the colon) get a title of None.
+    """
+    headers = []
+    prefix_len = len(_STEP_PREFIX)
+    pos = 0
+    while True:
+        # Jump straight to the next line that starts with the prefix
+        if not md.startswith(_STEP_PREFIX, pos):
+            pos = md.find("\n" + _STEP_PREFIX, pos)
+            if pos < 0:
+                break
+            pos += 1
+
+        line_end = md.find("\n", pos)
+        if line_end < 0:
+            line_end = len(md)
+
+        colon = md.find(":", pos + prefix_len, line_end)
+        number = md[pos + prefix_len : colon]
+        if colon > 0 and number.isdecimal():
+            title = None
+            if md.startswith(" ", colon + 1) and colon + 2 < line_end:
+                # Lines end in "\n"; drop the "\r" of CRLF text, as splitlines() did
+                title = md[colon + 2 : line_end].rstrip("\r") or None
+            headers.append((pos, line_end, int(number), title))
+        pos = line_end
+
+    return headers
 
 
 def parse_steps(md: str):
@@ -64,31 +143,23 @@ def parse_steps(md: str):
     Only numbered steps (## Step N: ...) are extracted.
     The intro/meta content at the top is ignored since we use st.title().
     """
-    lines = md.splitlines()
-    step_idxs = [
-        i for i, l in enumerate(lines) if re.match(r"## Step \d+:", l)
-    ]
-
     intro = ""
 
+    headers = _find_step_headers(md)
+    ends = [start for start, _, _, _ in headers[1:]] + [len(md)]
+
     steps = []
-    for i, start in enumerate(step_idxs):
-        end = step_idxs[i + 1] if i + 1 < len(step_idxs) else len(lines)
-        header = lines[start]
-        body = "\n".join(lines[start + 1 : end]).strip()
+    for (_, header_end, step_num, title), end in zip(headers, ends):
+        if title is None:
+            continue  # Ends the previous body, but isn't a step itself
         # Remove trailing horizontal rules from markdown
-        body = body.rstrip("-").rstrip()
-
-        m = re.match(r"## Step (\d+): (.+)", header)
-        if not m:
-            continue
-
-        step_num = int(m.group(1))
+        body = md[header_end:end].strip().rstrip("-").rstrip()
         steps.append(
             Step(
                 number=step_num,
-                title=m.group(2),
+                title=title,
                 body=body,
+                body_html=_MARKDOWN.render(body),
                 icon=STEP_ICONS.get(step_num, ":material/check_circle:"),
             )
         )
@@ -96,6 +167,21 @@ def parse_steps(md: str):
     return intro, steps
 
 
+def _workflow_mtime() -> float:
+    """Cache key for the workflow file: its mtime, or 0.0 if it's missing."""
+    try:
+        return WORKFLOW_MD.stat().st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+# One entry: an edit changes the mtime key, so older entries are dead weight
+@st.cache_data(show_spinner=False, max_entries=1)
+def _load_and_parse(path: str, mtime: float) -> tuple[str, list[Step]]:
+    """Load and parse the workflow file. mtime is only a cache key."""
+    return parse_steps(load_markdown(Path(path)))
+
+
 def get_encrypted_blob() -> str | None:
     """Get the encrypted secrets blob from st.secrets or return None."""
     try:
@@ -112,13 +198,22 @@ def _check_session_timeout() -> bool:
 
     elapsed = time.time() - last_activity
     if elapsed > SESSION_TIMEOUT_SECONDS:
-        # Session expired - clear secrets
-        st.session_state.pop("secrets", None)
+        # Session expired - forget the key
+        _forget_key()
         st.session_state.pop("last_activity", None)
         return False
     return True
 
 
+def _forget_key():
+    """Drop and zeroize the derived key held in session state."""
+    key = st.session_state.pop("secrets_key", None)
+    if key is not None:
+        from secrets_manager import zeroize
+
+        zeroize(key)
+
+
 def _update_activity():
     """Update last activity timestamp."""
     st.session_state.last_activity = time.time()
@@ -157,7 +252,9 @@ def unlock_gate():
 
     Security features:
     - Password is never stored in session state
-    - Unlocked state = presence of decrypted secrets
+    - Unlocked state = presence of the derived key; secrets are
+      decrypted on demand and never kept in session state
+    - Key derivation runs once per unlock, not once per rerun
     - Session timeout after inactivity
     - Rate limiting with escalating delays
     """
@@ -171,8 +268,8 @@ def unlock_gate():
     if not _check_session_timeout():
         st.warning("Session expired due to inactivity. Please log in again.")
 
-    # Already unlocked (secrets exist in session state)
-    if st.session_state.get("secrets"):
+    # Already unlocked (derived key exists in session state)
+    if st.session_state.get("secrets_key"):
         _update_activity()
         return True
 
@@ -182,18 +279,30 @@ def unlock_gate():
         st.error(f"Too many failed attempts. Please wait {int(lockout_remaining)} seconds.")
         st.stop()
 
+    # The gate lives in a placeholder: a successful unlock clears it and lets
+    # the app render in this same run instead of paying for st.rerun()
+    unlocked = False
+    gate = st.empty()
+
     # Use a form so password is submitted but not stored in session state
-    with st.form("unlock_form", clear_on_submit=True):
+    with gate.form("unlock_form", clear_on_submit=True):
         password = st.text_input("Password", type="password")
         submitted = st.form_submit_button("Unlock")
 
         if submitted and password:
-            secrets, error = try_decrypt_secrets(blob, password)
-            if secrets is not None:
-                st.session_state.secrets = secrets
+            # Skip the key derivation entirely for input that can't be the password
+            if len(password) < MIN_PASSWORD_LENGTH:
+                st.error("Password too short.")
+                return False
+
+            from secrets_manager import try_unlock_secrets
+
+            key, error = try_unlock_secrets(blob, password)
+            if key is not None:
+                st.session_state.secrets_key = key
                 _update_activity()
                 _clear_failed_attempts()
-                st.rerun()
+                unlocked = True
             else:
                 _record_failed_attempt()
                 lockout = _get_lockout_remaining()
@@ -202,12 +311,28 @@ def unlock_gate():
                 else:
                     st.error(error)
 
+    if unlocked:
+        gate.empty()
+        return True
+
     return False
 
 
 def get_secrets() -> dict:
-    """Get decrypted secrets from session state, or empty dict."""
-    return st.session_state.get("secrets") or {}
+    """Decrypt secrets with the session's key, or return empty dict."""
+    key = st.session_state.get("secrets_key")
+    blob = get_encrypted_blob()
+    if not key or not blob:
+        return {}
+
+    from secrets_manager import EncryptedBlob, decrypt_with_key
+
+    try:
+        return decrypt_with_key(EncryptedBlob.from_string(blob), key)
+    except Exception:
+        # Blob changed underneath us (e.g. secrets.toml edited): lock again
+        _forget_key()
+        return {}
 
 
 REPORT_TYPES = [
@@ -219,15 +344,73 @@ REPORT_TYPES = [
 
 def _all_reports_uploaded() -> bool:
     """Return True if all three QuickBooks report CSVs are in session state."""
-    return all(f"df_{key}" in st.session_state for key, _ in REPORT_TYPES)
+    return all(f"report_{key}" in st.session_state for key, _ in REPORT_TYPES)
 
 
-def _read_upload(uploaded) -> pd.DataFrame:
-    """Read a CSV or Excel upload into a DataFrame."""
-    name = uploaded.name.lower()
-    if name.endswith(".csv"):
-        return pd.read_csv(uploaded)
-    return pd.read_excel(uploaded)
+def _read_upload(content: bytes) -> pd.DataFrame:
+    """Read CSV or Excel bytes into a DataFrame, sniffing the format."""
+    # Deferred: pandas/pyarrow are only needed once someone uploads a report
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    # Trust the bytes, not the file name: .xlsx is a zip, .xls is OLE2
+    if content.startswith((XLSX_MAGIC, XLS_MAGIC)):
+        return pd.read_excel(io.BytesIO(content), engine=EXCEL_ENGINE)
+
+    # Arrow's CSV reader is multithreaded and reads the upload buffer in place,
+    # but it's stricter than pandas: ragged rows (e.g. short ones) fail
+    try:
+        table = pacsv.read_csv(pa.BufferReader(content))
+    except pa.ArrowInvalid:
+        return pd.read_csv(io.BytesIO(content), dtype_backend="pyarrow")
+
+    table = table.rename_columns(_dedupe_columns(table.column_names))
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _dedupe_columns(names: list[str]) -> list[str]:
+    """Rename blank and duplicate CSV headers the way pd.read_csv does."""
+    names = [name or f"Unnamed: {i}" for i, name in enumerate(names)]
+    taken = set(names)
+    counts: dict[str, int] = {}
+    for i, name in enumerate(names):
+        count = counts.get(name, 0)
+        original = name
+        while count > 0:
+            # "x.1" may itself be a header further along; skip past it
+            counts[original] = count + 1
+            name = f"{original}.{count}"
+            count = count + 1 if name in taken else counts.get(name, 0)
+        names[i] = name
+        counts[name] = count + 1
+    return names
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _parse_upload(digest: str, _content: bytes | None = None) -> pd.DataFrame:
+    """
+    Parse an upload, cached by content digest (_content is not hashed).
+
+    Called without _content it only looks the digest up, and raises
+    LookupError once the entry has been evicted (errors aren't cached).
+    """
+    if _content is None:
+        raise LookupError(f"Upload {digest} is no longer cached.")
+    return _read_upload(_content)
+
+
+def get_report(key: str) -> pd.DataFrame | None:
+    """Return the uploaded report DataFrame for a REPORT_TYPES key, if any."""
+    digest = st.session_state.get(f"report_{key}")
+    if digest is None:
+        return None
+    try:
+        return _parse_upload(digest)
+    except LookupError:
+        # Session state only keeps the digest: forget it so step 2 asks again
+        del st.session_state[f"report_{key}"]
+        return None
 
 
 def render_step_2_uploads():
@@ -241,22 +424,41 @@ def render_step_2_uploads():
                 key=f"upload_{key}",
             )
             if uploaded is not None:
-                try:
-                    df = _read_upload(uploaded)
-                    st.session_state[f"df_{key}"] = df
-                except Exception as e:
-                    st.error(f"Could not read {label} file: {e}")
+                content = uploaded.getvalue()
+                digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+                # Only validate new files; get_report() parses for the preview
+                if st.session_state.get(f"report_{key}") != digest:
+                    try:
+                        df = _parse_upload(digest, content)
+                        # st.dataframe can't show these; never store them
+                        if not df.columns.is_unique:
+                            raise ValueError("duplicate column names")
+                        st.session_state[f"report_{key}"] = digest
+                    except Exception as e:
+                        st.error(f"Could not read {label} file: {e}")
 
     for key, label in REPORT_TYPES:
-        if f"df_{key}" in st.session_state:
+        df = get_report(key)
+        if df is not None:
             st.subheader(label)
-            st.dataframe(st.session_state[f"df_{key}"], use_container_width=True)
+            st.dataframe(df, use_container_width=True)
+
+
+def _classify(step_number: int, active_step: int) -> str:
+    """Return "done", "active" or "future" for a step."""
+    if step_number < active_step:
+        return "done"
+    return "active" if step_number == active_step else "future"
+
+
+def _go_to_step(step_number: int):
+    """Button callback: make step_number the active step."""
+    st.session_state.active_step = step_number
 
 
 def workflow_page():
     """Main workflow page with step-by-step checklist."""
-    md = load_markdown()
-    intro, steps = parse_steps(md)
+    intro, steps = _load_and_parse(str(WORKFLOW_MD), _workflow_mtime())
 
     st.title("Month-End Workflow")
 
@@ -267,136 +469,163 @@ def workflow_page():
         st.markdown(intro)
         st.divider()
 
+    active_step = st.session_state.active_step
     for step in steps:
-        is_active = step.number == st.session_state.active_step
-        is_future = step.number > st.session_state.active_step
-        is_completed = step.number < st.session_state.active_step
-
-        # Choose icon based on state
-        if is_completed:
-            display_icon = ":material/check_circle:"
-        elif is_future:
-            display_icon = ":material/lock:"
-        else:
-            display_icon = step.icon
+        state = _classify(step.number, active_step)
+        display_icon = _ICON_FOR_STATE.get(state, step.icon)
+
+        # Completed steps track their open state so the body is only
+        # built and sent to the browser once the user expands it
+        lazy = {}
+        if state == "done":
+            lazy = {"key": f"expanded_{step.number}", "on_change": "rerun"}
 
         with st.expander(
             f"{display_icon} Step {step.number}: {step.title}",
-            expanded=is_active,
-        ):
-            if is_future:
-                st.caption("This step will unlock once you complete the previous step.")
-            else:
-                st.markdown(step.body)
-                if is_active and step.number == 2:
-                    render_step_2_uploads()
-                if is_active:
-                    disabled = (
-                        step.number == 2 and not _all_reports_uploaded()
-                    )
-                    st.button(
-                        "Mark Complete & Continue",
-                        key=f"next_{step.number}",
-                        type="primary",
-                        icon=":material/check:",
-                        disabled=disabled,
-                        on_click=lambda n=step.number: setattr(
-                            st.session_state, "active_step", n + 1
-                        ),
-                    )
-                    if disabled:
-                        st.caption(
-                            "Upload all three reports to continue."
-                        )
-                elif is_completed:
-                    st.button(
-                        "Return to this step",
-                        key=f"return_{step.number}",
-                        icon=":material/undo:",
-                        on_click=lambda n=step.number: setattr(
-                            st.session_state, "active_step", n
-                        ),
+            expanded=state == "active",
+            **lazy,
+        ) as expander:
+            if state == "future":
+                st.caption(_FUTURE_CAPTION)
+                continue
+            if state == "done" and not expander.open:
+                continue
+
+            st.markdown(step.body_html, unsafe_allow_html=True)
+            if state == "active" and step.number == 2:
+                render_step_2_uploads()
+            if state == "active":
+                disabled = (
+                    step.number == 2 and not _all_reports_uploaded()
+                )
+                st.button(
+                    "Mark Complete & Continue",
+                    key=f"next_{step.number}",
+                    type="primary",
+                    icon=":material/check:",
+                    disabled=disabled,
+                    on_click=_go_to_step,
+                    args=(step.number + 1,),
+                )
+                if disabled:
+                    st.caption(
+                        "Upload all three reports to continue."
                     )
+            else:
+                st.button(
+                    "Return to this step",
+                    key=f"return_{step.number}",
+                    icon=":material/undo:",
+                    on_click=_go_to_step,
+                    args=(step.number,),
+                )
 
     # Celebration when all steps are done
-    if steps and st.session_state.active_step > len(steps):
+    if steps and active_step > len(steps):
         st.balloons()
         st.success("Congrats, you did it! Go Muffin! 🧁")
 
 
+def _format_sa_json(service_account: dict) -> str:
+    """Pretty-print the Google service account JSON."""
+    if orjson is not None:
+        return orjson.dumps(service_account, option=orjson.OPT_INDENT_2).decode("utf-8")
+    return json.dumps(service_account, indent=2)
+
+
 def secrets_page():
     """Secrets management page."""
     st.title("Secrets")
 
+    st.markdown("Edit secrets below, then encrypt with a password.")
+
+    # Lazy: the editor's widgets (and the decrypt that fills them) only run
+    # while the expander is open
+    with st.expander(
+        "Edit & Re-encrypt",
+        icon=":material/edit:",
+        key="secrets_editor_open",
+        on_change="rerun",
+    ) as editor:
+        if editor.open:
+            _secrets_editor()
+
+
+def _secrets_editor():
+    """Secret fields plus the encrypt form, prefilled from current secrets."""
     current = get_secrets()
 
-    st.markdown("Edit secrets below, then encrypt with a password.")
+    # A form so typing doesn't rerun the page; only the submit button does
+    with st.form("edit_secrets_form"):
+        # All secret fields are hidden by default for security
+        test_secret = st.text_input(
+            "Test Secret",
+            value=current.get("test_secret", ""),
+            type="password",
+            key="test_secret",
+        )
 
-    # All secret fields are hidden by default for security
-    test_secret = st.text_input(
-        "Test Secret",
-        value=current.get("test_secret", ""),
-        type="password",
-        key="test_secret",
-    )
+        qbo_client_id = st.text_input(
+            "QuickBooks Client ID",
+            value=current.get("qbo_client_id", ""),
+            type="password",
+            key="qbo_client_id",
+        )
 
-    qbo_client_id = st.text_input(
-        "QuickBooks Client ID",
-        value=current.get("qbo_client_id", ""),
-        type="password",
-        key="qbo_client_id",
-    )
+        qbo_client_secret = st.text_input(
+            "QuickBooks Client Secret",
+            value=current.get("qbo_client_secret", ""),
+            type="password",
+            key="qbo_client_secret",
+        )
 
-    qbo_client_secret = st.text_input(
-        "QuickBooks Client Secret",
-        value=current.get("qbo_client_secret", ""),
-        type="password",
-        key="qbo_client_secret",
-    )
+        # Once rendered, the text area keeps its own value in session state
+        # (key="google_sa") and ignores value=, so only format it the first time
+        google_sa_default = ""
+        if "google_sa" not in st.session_state and current.get("google_service_account"):
+            google_sa_default = _format_sa_json(current["google_service_account"])
+
+        # Note: text_area doesn't support type="password", but the value is still
+        # pre-populated from session state (not visible in page source until rendered)
+        google_sa_input = st.text_area(
+            "Google Service Account JSON",
+            value=google_sa_default,
+            height=150,
+            key="google_sa",
+        )
 
-    google_sa_default = ""
-    if current.get("google_service_account"):
-        google_sa_default = json.dumps(current["google_service_account"], indent=2)
-
-    # Note: text_area doesn't support type="password", but the value is still
-    # pre-populated from session state (not visible in page source until rendered)
-    google_sa_input = st.text_area(
-        "Google Service Account JSON",
-        value=google_sa_default,
-        height=150,
-        key="google_sa",
-    )
+        st.divider()
 
-    st.divider()
+        st.subheader("Encrypt with Password")
 
-    st.subheader("Encrypt with Password")
+        new_password = st.text_input(
+            "Password",
+            type="password",
+            key="new_password",
+        )
+        confirm_password = st.text_input(
+            "Confirm Password",
+            type="password",
+            key="confirm_password",
+        )
 
-    new_password = st.text_input(
-        "Password",
-        type="password",
-        key="new_password",
-    )
-    confirm_password = st.text_input(
-        "Confirm Password",
-        type="password",
-        key="confirm_password",
-    )
+        submitted = st.form_submit_button("Encrypt & Generate Blob", type="primary")
 
-    if st.button("Encrypt & Generate Blob", type="primary"):
+    if submitted:
         errors = []
 
         if not new_password:
             errors.append("Password is required.")
         elif new_password != confirm_password:
             errors.append("Passwords do not match.")
-        elif len(new_password) < 8:
-            errors.append("Password must be at least 8 characters.")
+        elif len(new_password) < MIN_PASSWORD_LENGTH:
+            errors.append(f"Password must be at least {MIN_PASSWORD_LENGTH} characters.")
 
         # Parse Google SA JSON
         google_sa = None
         if google_sa_input.strip():
             try:
-                google_sa = json.loads(google_sa_input)
+                google_sa = (orjson or json).loads(google_sa_input)
             except json.JSONDecodeError as e:
                 errors.append(f"Invalid Google SA JSON: {e}")
 
@@ -415,6 +644,8 @@ def secrets_page():
             if google_sa:
                 new_secrets["google_service_account"] = google_sa
 
+            from secrets_manager import encrypt_secrets
+
             encrypted = encrypt_secrets(new_secrets, new_password)
 
             st.success("Secrets encrypted!")
@@ -424,18 +655,27 @@ def secrets_page():
 def config_page():
     """Config page displaying session state for debugging."""
     st.title("Config")
-    st.markdown("Current session state variables:")
-
-    # Filter out sensitive data from display
-    SENSITIVE_KEYS = {"secrets", "unlock_password"}
-    safe_state = {}
-    for key, value in st.session_state.items():
-        if key in SENSITIVE_KEYS:
-            safe_state[key] = "[REDACTED]"
-        else:
-            safe_state[key] = value
 
-    st.json(safe_state)
+    # Lazy: the state dump is only built and serialized while it's open
+    with st.expander(
+        "Current session state variables",
+        icon=":material/bug_report:",
+        key="session_state_open",
+        on_change="rerun",
+    ) as state_view:
+        if not state_view.open:
+            return
+
+        # Filter out sensitive data from display
+        SENSITIVE_KEYS = {"secrets_key", "unlock_password"}
+        safe_state = {}
+        for key, value in st.session_state.items():
+            if key in SENSITIVE_KEYS:
+                safe_state[key] = "[REDACTED]"
+            else:
+                safe_state[key] = value
+
+        st.json(safe_state)
 
 
 def main():